@@ -1,10 +1,16 @@
+import io
+import os
+import tempfile
+import time
+from pathlib import Path
 import streamlit as st
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 import requests
-import folium
-from streamlit_folium import st_folium
+import orjson
+import pyarrow as pa
+import pydeck as pdk
 import numpy as np
 
 # -------------------------------------------------------
@@ -25,22 +31,22 @@ Incluye filtros avanzados, mapas, gráficos y análisis automáticos.
 # -------------------------------------------------------
 # API oficial
 # -------------------------------------------------------
-API_URL = (
-    "https://datos.gob.cl/api/3/action/datastore_search"
-    "?resource_id=2c44d782-3365-44e3-aefb-2c8b8363a1bc"
-    "&limit=5000"
-)
-
-with st.spinner("Cargando datos desde la API..."):
-    response = requests.get(API_URL)
-    data = response.json()
-    records = data["result"]["records"]
-    df = pd.DataFrame(records)
-
-# -------------------------------------------------------
-# Normalización de columnas
-# -------------------------------------------------------
-df = df.rename(columns={
+API_URL = "https://datos.gob.cl/api/3/action/datastore_search"
+RESOURCE_ID = "2c44d782-3365-44e3-aefb-2c8b8363a1bc"
+PAGE_SIZE = 5000
+CACHE_TTL = 3600
+CACHE_MAX_ENTRADAS = 32  # tope de resultados por filtro guardados en memoria
+
+# Copia local en Parquet para que un reinicio del proceso no vuelva a descargar.
+# Subir CACHE_VERSION cada vez que cambien las columnas que guarda cargar_datos.
+CACHE_DIR = Path(tempfile.gettempdir())
+CACHE_VERSION = 2
+
+# Grupos de tipo que tienen gráfico propio; el resto queda como "Otro"
+TIPOS_GRAFICO = ["Hospital", "Clínica", "CESFAM"]
+
+# Columnas que usa la app y su nombre corto; la API solo envía estas
+COLUMNAS = {
     "RegionGlosa": "Region",
     "ComunaGlosa": "Comuna",
     "EstablecimientoGlosa": "Nombre",
@@ -49,13 +55,123 @@ df = df.rename(columns={
     "Longitud": "Lon",
     "TieneServicioUrgencia": "Urgencia",
     "TipoUrgencia": "UrgenciaTipo",
-})
+}
+
+
+# Columnas de texto y categóricas del DataFrame limpio
+COLUMNAS_TEXTO = ["Region", "Comuna", "Nombre", "Tipo", "TipoCat", "Urgencia", "UrgenciaTipo"]
+COLUMNAS_CATEGORIA = ["Region", "Comuna", "Tipo", "TipoCat"]
+
+# Columnas que debe tener el DataFrame limpio (incluye las derivadas en cargar_datos)
+COLUMNAS_CACHE = set(COLUMNAS.values()) | {"LatRad", "LonRad", "TipoCat"}
+
+
+def descargar_datos(url, resource_id, page_size=PAGE_SIZE):
+    # Descarga por páginas: cada página pasa directo a Arrow y se suelta antes de la siguiente
+    tablas = []
+    offset = 0
+    while True:
+        response = requests.get(url, params={
+            "resource_id": resource_id,
+            "limit": page_size,
+            "offset": offset,
+            "sort": "_id",  # orden fijo: sin él las páginas pueden repetir o saltar filas
+            "fields": ",".join(COLUMNAS),
+        })
+        response.raise_for_status()
+        records = orjson.loads(response.content)["result"]["records"]
+        if records:
+            tablas.append(pa.Table.from_pylist(records))
+        if len(records) < page_size:
+            break
+        offset += page_size
+    if not tablas:
+        raise RuntimeError(f"La API de datos.gob.cl no devolvió registros para {resource_id}.")
+    tabla = pa.concat_tables(tablas, promote_options="default")
+    return tabla.to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def opciones_filtros(df):
+    # Listas para los selectores del sidebar, calculadas junto con los datos
+    return {
+        "regiones": sorted(df["Region"].unique().tolist()),
+        "tipos": sorted(df["Tipo"].unique().tolist()),
+        "comunas": sorted(df["Comuna"].unique().tolist()),
+        "comunas_por_region": {
+            region: sorted(g.unique().tolist())
+            for region, g in df.groupby("Region", observed=True)["Comuna"]
+        },
+    }
+
+
+def aplicar_tipos(df):
+    # Mismos tipos al descargar y al leer el Parquet, que no conserva los de Arrow
+    df = df.astype({c: "string[pyarrow]" for c in COLUMNAS_TEXTO} | {"Lat": "float64", "Lon": "float64"})
+
+    # Región, comuna y tipo se repiten mucho: como categorías se comparan por código
+    return df.astype({c: "category" for c in COLUMNAS_CATEGORIA})
 
-# Convertir coordenadas a float
-df["Lat"] = pd.to_numeric(df["Lat"], errors="coerce")
-df["Lon"] = pd.to_numeric(df["Lon"], errors="coerce")
 
-df = df.dropna(subset=["Region", "Comuna", "Nombre", "Tipo"])
+# -------------------------------------------------------
+# Normalización de columnas
+# -------------------------------------------------------
+@st.cache_data(ttl=CACHE_TTL, show_spinner="Cargando datos desde la API...")
+def cargar_datos(url, resource_id):
+    # Se cachea el DataFrame ya limpio (y sus opciones de filtro), no el crudo
+    archivo = CACHE_DIR / f"establecimientos_{resource_id}_v{CACHE_VERSION}.parquet"
+    if archivo.exists() and time.time() - archivo.stat().st_mtime < CACHE_TTL:
+        df = pd.read_parquet(archivo)
+        # Un archivo con otras columnas (código anterior) se ignora y se vuelve a descargar
+        if COLUMNAS_CACHE.issubset(df.columns):
+            df = aplicar_tipos(df)
+            return df, opciones_filtros(df), archivo.stat().st_mtime
+
+    version = time.time()
+    df = descargar_datos(url, resource_id)
+    df = df.rename(columns=COLUMNAS)
+
+    # Convertir coordenadas a float
+    df["Lat"] = pd.to_numeric(df["Lat"], errors="coerce")
+    df["Lon"] = pd.to_numeric(df["Lon"], errors="coerce")
+
+    # Coordenadas en radianes (float64 de NumPy) para el cálculo de distancias
+    df["LatRad"] = np.radians(df["Lat"].to_numpy(dtype=float, na_value=np.nan))
+    df["LonRad"] = np.radians(df["Lon"].to_numpy(dtype=float, na_value=np.nan))
+
+    df = df.dropna(subset=["Region", "Comuna", "Nombre", "Tipo"])
+
+    # Columnas de texto respaldadas por Arrow (filtros y conteos más rápidos)
+    df = df.astype({c: "string[pyarrow]" for c in ["Region", "Comuna", "Nombre", "Tipo"]})
+    for c in ["Region", "Comuna", "Nombre", "Tipo"]:
+        df[c] = df[c].str.strip()
+
+    # Grupo de tipo calculado una sola vez aquí, no en cada rerun
+    df["TipoCat"] = np.select(
+        [df["Tipo"].str.contains(k, case=False, regex=False, na=False).to_numpy(dtype=bool)
+         for k in TIPOS_GRAFICO],
+        TIPOS_GRAFICO,
+        default="Otro",
+    )
+
+    df = aplicar_tipos(df)
+
+    # Se escribe a un temporal y se reemplaza: otro proceso nunca lee un archivo a medias
+    temporal = archivo.with_name(f"{archivo.name}.{os.getpid()}.tmp")
+    try:
+        df.to_parquet(temporal, compression="zstd")
+        os.replace(temporal, archivo)
+    except OSError:
+        temporal.unlink(missing_ok=True)  # sin disco escribible la app sigue, solo sin copia local
+    return df, opciones_filtros(df), version
+
+
+# version identifica la carga: cambia cada vez que los datos se refrescan
+df, opciones, version = cargar_datos(API_URL, RESOURCE_ID)
+
+# Un Parquet leído casi vencido no debe quedar otra hora completa en memoria
+if time.time() - version > CACHE_TTL:
+    cargar_datos.clear()
+    df, opciones, version = cargar_datos(API_URL, RESOURCE_ID)
 
 # -------------------------------------------------------
 # SIDEBAR – FILTROS
@@ -63,32 +179,49 @@ df = df.dropna(subset=["Region", "Comuna", "Nombre", "Tipo"])
 st.sidebar.title("🔍 Filtros")
 
 # Filtro región
-regiones = sorted(df["Region"].unique())
+regiones = opciones["regiones"]
 region_sel = st.sidebar.selectbox("Región:", ["Todas"] + regiones)
 
-df_filt = df.copy() if region_sel == "Todas" else df[df["Region"] == region_sel]
+# Todos los filtros se acumulan en una sola máscara y se aplican al final
+mask = np.ones(len(df), dtype=bool)
+
+if region_sel != "Todas":
+    mask &= (df["Region"] == region_sel).to_numpy(dtype=bool)
 
 # Filtro comuna
-comunas = sorted(df_filt["Comuna"].unique())
+if region_sel == "Todas":
+    comunas = opciones["comunas"]
+else:
+    comunas = opciones["comunas_por_region"][region_sel]
 comuna_sel = st.sidebar.selectbox("Comuna:", ["Todas"] + comunas)
 
 if comuna_sel != "Todas":
-    df_filt = df_filt[df_filt["Comuna"] == comuna_sel]
+    mask &= (df["Comuna"] == comuna_sel).to_numpy(dtype=bool)
 
 # Filtro tipo
-tipos = sorted(df["Tipo"].unique())
+tipos = opciones["tipos"]
 tipo_sel = st.sidebar.multiselect("Tipo de establecimiento:", tipos, default=tipos)
 
-df_filt = df_filt[df_filt["Tipo"].isin(tipo_sel)]
+mask &= df["Tipo"].isin(tipo_sel).to_numpy(dtype=bool)
 
 # Filtro urgencia
 urgencias_opciones = ["Todos", "Público", "Privado"]
 urg_sel = st.sidebar.selectbox("Servicio de Urgencias:", urgencias_opciones)
 
 if urg_sel == "Público":
-    df_filt = df_filt[df_filt["UrgenciaTipo"].str.contains("Público", na=False)]
+    mask &= df["UrgenciaTipo"].str.contains("Público", regex=False, na=False).to_numpy(dtype=bool)
 elif urg_sel == "Privado":
-    df_filt = df_filt[df_filt["UrgenciaTipo"].str.contains("Privado", na=False)]
+    mask &= df["UrgenciaTipo"].str.contains("Privado", regex=False, na=False).to_numpy(dtype=bool)
+
+# Búsqueda por nombre (subcadena literal, resuelta por Arrow)
+busqueda = st.sidebar.text_input("Buscar por nombre:", key="q")
+
+# Sin texto útil (vacío o un solo carácter) no se recorre la columna
+q = busqueda.strip()
+if len(q) >= 2:
+    mask &= df["Nombre"].str.contains(q, case=False, regex=False, na=False).to_numpy(dtype=bool)
+
+df_filt = df[mask]
 
 # -------------------------------------------------------
 # RESULTADOS
@@ -101,6 +234,29 @@ if df_filt.empty:
 
 st.success(f"Se encontraron **{len(df_filt)}** establecimientos.")
 
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRADAS)
+def csv_filtrado(_df, version, filtros):
+    # La clave es la versión de los datos más los filtros: el DataFrame no se hashea
+    return _df[list(COLUMNAS.values())].to_csv(index=False).encode("utf-8")
+
+
+filtros = (region_sel, comuna_sel, tuple(tipo_sel), urg_sel, q)
+st.download_button(
+    "⬇️ Descargar resultados (CSV)",
+    data=csv_filtrado(df_filt, version, filtros),
+    file_name="establecimientos_filtrados.csv",
+    mime="text/csv",
+)
+
+# Un solo conteo por (región, comuna, tipo, grupo); gráficos y rankings salen de aquí
+agg = df_filt.groupby(["Region", "Comuna", "Tipo", "TipoCat"], observed=True).size()
+
+
+def total_por(conteos, nivel):
+    return conteos.groupby(level=nivel, observed=True).sum().sort_values(ascending=False)
+
+
 # -------------------------------------------------------
 # MAPA
 # -------------------------------------------------------
@@ -111,58 +267,101 @@ df_map = df_filt.dropna(subset=["Lat", "Lon"])
 if df_map.empty:
     st.warning("No hay coordenadas disponibles para este filtro.")
 else:
-    m = folium.Map(location=[-33.45, -70.65], zoom_start=5)
-
-    for _, row in df_map.iterrows():
-        folium.Marker(
-            [row["Lat"], row["Lon"]],
-            popup=f"{row['Nombre']}<br>{row['Tipo']}<br>{row['Comuna']}",
-            tooltip=row["Nombre"]
-        ).add_to(m)
-
-    st_folium(m, height=480)
+    # Capa WebGL: los puntos se envían como columnas, sin un objeto por fila
+    capa = pdk.Layer(
+        "ScatterplotLayer",
+        df_map[["Lon", "Lat", "Nombre", "Tipo", "Comuna"]],
+        get_position=["Lon", "Lat"],
+        get_radius=200,
+        radius_min_pixels=3,
+        get_fill_color=[200, 30, 30, 160],
+        pickable=True,
+    )
+
+    st.pydeck_chart(pdk.Deck(
+        layers=[capa],
+        initial_view_state=pdk.ViewState(latitude=-33.45, longitude=-70.65, zoom=5),
+        tooltip={"html": "<b>{Nombre}</b><br>{Tipo}<br>{Comuna}"},
+    ))
 
 # -------------------------------------------------------
 # GRÁFICOS
 # -------------------------------------------------------
 st.subheader("📊 Gráficos por tipo de establecimiento")
 
+
+def figura_png(fig):
+    # PNG en memoria y figura cerrada: no quedan figuras vivas entre reruns
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=90, bbox_inches="tight")
+    plt.close(fig)
+    return buf.getvalue()
+
+
+@st.cache_data(max_entries=CACHE_MAX_ENTRADAS)
+def grafico_barras(conteos, figsize=(6.4, 4.8)):
+    # Se cachea por conteos: si el filtro no cambia el gráfico no se redibuja
+    fig, ax = plt.subplots(figsize=figsize)
+    if conteos:
+        sns.barplot(x=list(conteos.values()), y=list(conteos.keys()), ax=ax)
+    ax.set(xlabel="count", ylabel="Region")
+    return figura_png(fig)
+
+
+@st.cache_data(max_entries=CACHE_MAX_ENTRADAS)
+def grafico_torta(conteos):
+    fig, ax = plt.subplots()
+    pd.Series(conteos).plot.pie(ax=ax, autopct="%1.1f%%")
+    return figura_png(fig)
+
+
+# Grupo de tipo × región en una sola pasada; cada gráfico toma una fila
+por_tipo = agg.groupby(level=["TipoCat", "Region"], observed=True).sum().unstack(fill_value=0)
+
+
+def conteo_por_tipo(tipo):
+    if tipo not in por_tipo.index:
+        return {}
+    fila = por_tipo.loc[tipo]
+    return fila[fila > 0].sort_values(ascending=False).to_dict()
+
+
 col1, col2 = st.columns(2)
 
 # Hospitales
 with col1:
     st.write("### Hospitales por región")
-    hos = df_filt[df_filt["Tipo"].str.contains("Hospital", case=False)]
-    fig, ax = plt.subplots()
-    sns.countplot(data=hos, y="Region", order=hos["Region"].value_counts().index)
-    st.pyplot(fig)
+    st.image(grafico_barras(conteo_por_tipo("Hospital")), width="stretch")
 
 # Clínicas
 with col2:
     st.write("### Clínicas por región")
-    cli = df_filt[df_filt["Tipo"].str.contains("Clínica", case=False)]
-    fig, ax = plt.subplots()
-    sns.countplot(data=cli, y="Region", order=cli["Region"].value_counts().index)
-    st.pyplot(fig)
+    st.image(grafico_barras(conteo_por_tipo("Clínica")), width="stretch")
 
 # CESFAM
 st.write("### CESFAM por región")
-cesfam = df_filt[df_filt["Tipo"].str.contains("CESFAM", case=False)]
-fig, ax = plt.subplots(figsize=(8,4))
-sns.countplot(data=cesfam, y="Region", order=cesfam["Region"].value_counts().index)
-st.pyplot(fig)
+st.image(grafico_barras(conteo_por_tipo("CESFAM"), figsize=(8, 4)), width="stretch")
 
 # General
 st.write("### Total de establecimientos por región")
-fig, ax = plt.subplots(figsize=(8,4))
-sns.countplot(data=df_filt, y="Region", order=df_filt["Region"].value_counts().index)
-st.pyplot(fig)
+conteo_total = total_por(agg, "Region").to_dict()
+st.image(grafico_barras(conteo_total, figsize=(8, 4)), width="stretch")
 
 # -------------------------------------------------------
 # 🔥 INTERACCIONES AVANZADAS
 # -------------------------------------------------------
 st.subheader("🤖 Interacciones avanzadas")
 
+# Tablas nativas de Streamlit (Arrow + filas virtualizadas), sin HTML por fila
+config_columnas = {
+    "Region": st.column_config.TextColumn("🗺️ Región"),
+    "Comuna": st.column_config.TextColumn("Comuna"),
+    "Nombre": st.column_config.TextColumn("Establecimiento"),
+    "Tipo": st.column_config.TextColumn("Tipo"),
+    "UrgenciaTipo": st.column_config.TextColumn("Tipo de urgencia"),
+    "Distancia": st.column_config.NumberColumn("Distancia (km)", format="%.1f"),
+}
+
 tab1, tab2, tab3, tab4 = st.tabs([
     "📍 Buscar establecimientos cercanos",
     "⏱ Urgencia 24 horas",
@@ -176,36 +375,49 @@ with tab1:
     lon_user = st.number_input("Tu longitud:", value=-70.65)
     radio_km = st.slider("Radio (km):", 1, 50, 10)
 
-    def dist(lat1, lon1, lat2, lon2):
-        return 6371 * np.arccos(
-            np.cos(np.radians(lat1)) *
-            np.cos(np.radians(lat2)) *
-            np.cos(np.radians(lon2) - np.radians(lon1)) +
-            np.sin(np.radians(lat1)) *
-            np.sin(np.radians(lat2))
-        )
+    # Caja de búsqueda aproximada: 1° de latitud ≈ 111 km
+    delta_lat = radio_km / 111
+    delta_lon = radio_km / (111 * max(np.cos(np.radians(lat_user)), 1e-6))
+    candidatos = df_map[
+        ((df_map["Lat"] - lat_user).abs() <= delta_lat) &
+        ((df_map["Lon"] - lon_user).abs() <= delta_lon)
+    ]
 
-    df_dist = df_map.copy()
-    df_dist["Distancia"] = df_dist.apply(
-        lambda r: dist(lat_user, lon_user, r["Lat"], r["Lon"]), axis=1)
+    # Aproximación equirectangular: precisa para radios de pocas decenas de km
+    # Operaciones en el mismo arreglo: sin temporales extra por cada paso
+    x = candidatos["LonRad"].to_numpy() - np.radians(lon_user)
+    x *= np.cos(np.radians(lat_user))
+    y = candidatos["LatRad"].to_numpy() - np.radians(lat_user)
+    d = np.hypot(x, y, out=x)
+    d *= 6371
+
+    df_dist = candidatos.assign(Distancia=d)
 
     cerca = df_dist[df_dist["Distancia"] <= radio_km]
-    st.write(cerca[["Nombre", "Tipo", "Comuna", "Distancia"]])
+    st.dataframe(
+        cerca[["Nombre", "Tipo", "Comuna", "Distancia"]].sort_values("Distancia"),
+        hide_index=True,
+        width="stretch",
+        column_config=config_columnas,
+    )
 
 # 2 — Urgencia 24h
 with tab2:
-    urg24 = df_filt[df_filt["Urgencia"].str.contains("Sí", na=False)]
+    urg24 = df_filt[df_filt["Urgencia"].str.contains("Sí", regex=False, na=False)]
     st.write(f"Urgencias 24h encontradas: **{len(urg24)}**")
-    st.dataframe(urg24)
+    st.dataframe(
+        urg24[["Region", "Comuna", "Nombre", "Tipo", "UrgenciaTipo"]].sort_values(["Region", "Comuna"]),
+        hide_index=True,
+        width="stretch",
+        column_config=config_columnas,
+    )
 
 # 3 — Pie chart
 with tab3:
-    fig, ax = plt.subplots()
-    df_filt["Tipo"].value_counts().plot.pie(autopct="%1.1f%%")
-    st.pyplot(fig)
+    st.image(grafico_torta(total_por(agg, "Tipo").to_dict()), width="stretch")
 
 # 4 — Ranking comunas
 with tab4:
-    ranking = df_filt["Comuna"].value_counts().head(10)
+    ranking = total_por(agg, "Comuna").head(10)
     st.write("### Comunas con más centros de salud")
     st.bar_chart(ranking)